@@ -2,7 +2,7 @@
 # database.py – Future-Proof Version for Taco Group HDPE
 # Steps 1 → 42 + Step 43 (ScheduledJob Table)
 # =====================================================
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime
+from sqlalchemy import create_engine, inspect, Column, Integer, String, Float, DateTime
 from sqlalchemy.orm import sessionmaker, declarative_base
 from datetime import datetime, timezone
 import os
@@ -12,13 +12,45 @@ import os
 # =====================================================
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./production.db")
 
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+IS_POSTGRES = DATABASE_URL.startswith("postgresql")
+
+# Persistent pool for the background loops + request handlers.
+# LIFO hands back the most recently used (warm) connection first.
+POOL_OPTIONS = {} if IS_SQLITE else {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+    "pool_use_lifo": True,
+}
+
 engine = create_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {},
+    connect_args={"check_same_thread": False} if IS_SQLITE else {},
     pool_pre_ping=True,
-    future=True
+    future=True,
+    **POOL_OPTIONS
 )
 
+# PostgreSQL only: every machine start is announced on this channel,
+# so the meter loop wakes no matter which process made the change.
+MACHINE_EVENTS_CHANNEL = "machine_events"
+MACHINE_EVENTS_DDL = f"""
+CREATE OR REPLACE FUNCTION notify_machine_event() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{MACHINE_EVENTS_CHANNEL}', NEW.id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS machine_status_notify ON machines;
+CREATE TRIGGER machine_status_notify
+    AFTER UPDATE OF status ON machines
+    FOR EACH ROW WHEN (NEW.status = 'running' AND OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE PROCEDURE notify_machine_event();
+"""
+
 SessionLocal = sessionmaker(
     autocommit=False,
     autoflush=False,
@@ -45,7 +77,7 @@ class Machine(Base):
     target_qty = Column(Integer, default=0)
     produced_qty = Column(Integer, default=0)
     seconds_per_meter = Column(Float, default=0)
-    last_tick_time = Column(DateTime, nullable=True)
+    last_tick_time = Column(DateTime(timezone=True), nullable=True)
     erpnext_work_order_id = Column(String, nullable=True)
 
 
@@ -62,7 +94,7 @@ class ProductionLog(Base):
     produced_qty = Column(Integer, default=0)
     remaining_qty = Column(Integer, default=0)
     status = Column(String, nullable=False, default="running")
-    timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    timestamp = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
 
 class ERPNextMetadata(Base):
@@ -74,7 +106,7 @@ class ERPNextMetadata(Base):
     work_order = Column(String, nullable=False)
     erp_status = Column(String, default="Not Started")
     erp_comments = Column(String, nullable=True)
-    last_synced = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    last_synced = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
 
 # =====================================================
@@ -93,7 +125,27 @@ class ScheduledJob(Base):
     priority = Column(Integer, default=0)  # Higher = urgent
     assigned_machine_id = Column(Integer, nullable=True)  # None = not assigned
     eta_seconds = Column(Float, nullable=True)
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+
+# =====================================================
+# IN-PLACE UPGRADE FOR EXISTING DATABASES
+# =====================================================
+def _upgrade_machines_table():
+    """
+    create_all skips tables that already exist, so columns and indexes
+    added to models.Machine later are applied here. Idempotent.
+    """
+    columns = {c["name"] for c in inspect(engine).get_columns("machines")}
+    if "is_locked" not in columns:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                "ALTER TABLE machines ADD COLUMN is_locked BOOLEAN NOT NULL "
+                f"DEFAULT {'0' if IS_SQLITE else 'FALSE'}"
+            )
+
+    for index in Base.metadata.tables["machines"].indexes:
+        index.create(bind=engine, checkfirst=True)
 
 
 # =====================================================
@@ -104,5 +156,11 @@ def init_db():
     Creates all tables including machines, future-proof logs,
     ERPNext metadata, and ScheduledJob for Step 43.
     Safe to call multiple times without breaking existing tables.
+    Existing databases get the columns/indexes added since they were created.
+    On PostgreSQL also (re)creates the machine status NOTIFY trigger.
     """
-    Base.metadata.create_all(bind=engine)  
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    _upgrade_machines_table()
+    if IS_POSTGRES:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(MACHINE_EVENTS_DDL)
\ No newline at end of file
@@ -1,5 +1,7 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # =====================================================
@@ -17,6 +19,20 @@ if ERP_API_KEY and ERP_API_SECRET:
         "Content-Type": "application/json"
     }
 
+TIMEOUT = 10
+
+# =====================================================
+# Shared session: keep-alive + TLS reuse across ERP calls
+# =====================================================
+session = requests.Session()
+session.headers.update(HEADERS)
+session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+))
+session.mount("http://", session.get_adapter("https://"))
+
 # =====================================================
 # CREATE WORK ORDER IN ERP
 # =====================================================
@@ -26,7 +42,7 @@ def create_work_order(machine_id, qty):
 
     payload = {"machine_id": machine_id, "qty": qty}
     try:
-        res = requests.post(f"{ERP_URL}/api/method/create_work_order", json=payload, headers=HEADERS, timeout=10)
+        res = session.post(f"{ERP_URL}/api/method/create_work_order", json=payload, timeout=TIMEOUT)
         res.raise_for_status()
         return res.json()
     except requests.RequestException as e:
@@ -41,7 +57,7 @@ def update_work_order_status(machine_id, status):
 
     payload = {"machine_id": machine_id, "status": status}
     try:
-        res = requests.post(f"{ERP_URL}/api/method/update_work_order_status", json=payload, headers=HEADERS, timeout=10)
+        res = session.post(f"{ERP_URL}/api/method/update_work_order_status", json=payload, timeout=TIMEOUT)
         res.raise_for_status()
         return res.json()
     except requests.RequestException as e:
@@ -5,10 +5,15 @@
 # =====================================================
 
 import os
-import requests
+import json
+import logging
+import time
+import hashlib
+import httpx
 import asyncio
+from collections import defaultdict
 from typing import List, Dict
-from datetime import datetime
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -19,11 +24,15 @@ from models import Machine, ERPNextMetadata
 # ERP CONFIG
 # =====================================================
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 ERP_URL = os.getenv("ERP_URL")
 API_KEY = os.getenv("ERP_API_KEY")
 API_SECRET = os.getenv("ERP_API_SECRET")
 TIMEOUT = 10
+WORK_ORDER_CACHE_TTL = 5  # seconds; mainly collapses concurrent callers into one ERP GET
+ERP_SYNC_MAX_INTERVAL = 60  # seconds between syncs when nothing wakes the loop
+ERP_STATUS_FLUSH_INTERVAL = 0.5  # seconds to gather status changes into one request
 
 HEADERS = {
     "Authorization": f"token {API_KEY}:{API_SECRET}",
@@ -31,19 +40,42 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
+# Shared async client: keeps TCP/TLS connections to ERPNext alive between calls
+http_client = httpx.AsyncClient(
+    headers=HEADERS,
+    timeout=TIMEOUT,
+    limits=httpx.Limits(max_keepalive_connections=20)
+)
+
 # =====================================================
 # FETCH ACTIVE WORK ORDERS FROM ERPNext
 # =====================================================
-def get_work_orders() -> List[Dict]:
+_work_order_cache = {"ts": 0.0, "val": []}
+_work_order_lock = asyncio.Lock()
+
+async def get_work_orders(max_age: float = WORK_ORDER_CACHE_TTL) -> List[Dict]:
     """
     Fetch ONLY actionable ERPNext Work Orders
     Allowed statuses:
     - Not Started
     - In Process
+    Results are cached for `max_age` seconds (0 forces a refresh).
+    Concurrent callers share one in-flight fetch instead of each hitting ERP.
     """
     if not ERP_URL or not API_KEY or not API_SECRET:
         return []
 
+    called_at = time.monotonic()
+    if called_at - _work_order_cache["ts"] < max_age:
+        return _work_order_cache["val"]
+
+    async with _work_order_lock:
+        # Another caller refreshed the cache while we waited for the lock
+        if _work_order_cache["ts"] > called_at:
+            return _work_order_cache["val"]
+        return await _fetch_work_orders()
+
+async def _fetch_work_orders() -> List[Dict]:
     url = f"{ERP_URL}/api/resource/Work Order"
     params = {
         "fields": (
@@ -54,50 +86,154 @@ def get_work_orders() -> List[Dict]:
     }
 
     try:
-        resp = requests.get(url, headers=HEADERS, params=params, timeout=TIMEOUT)
+        resp = await http_client.get(url, params=params)
         resp.raise_for_status()
-        return resp.json().get("data", []) or []
+        work_orders = resp.json().get("data", []) or []
     except Exception as e:
         print("❌ ERP fetch error:", e)
-        return []
+        work_orders = []
+
+    # Failures are cached too, so an ERP outage costs one timeout per TTL
+    _work_order_cache["ts"] = time.monotonic()
+    _work_order_cache["val"] = work_orders
+    return work_orders
 
 # =====================================================
 # UPDATE ERP WORK ORDER STATUS
 # =====================================================
+_pending_statuses: Dict[str, str] = {}  # Work Order -> latest status not yet sent
+_status_wake = asyncio.Event()
+
 def update_work_order_status(erp_work_order_id: str, status: str):
     """
-    Update ERPNext Work Order status:
+    Queue an ERPNext Work Order status change:
     - In Process
     - Completed
+    Sent in batches by erp_status_flusher, so callers never wait on ERP.
     """
+    if erp_work_order_id:
+        _pending_statuses[erp_work_order_id] = status
+        _status_wake.set()
+
+async def _put_work_order_status(erp_work_order_id: str, status: str):
     try:
         url = f"{ERP_URL}/api/resource/Work Order/{erp_work_order_id}"
-        requests.put(
-            url,
-            json={"status": status},
-            headers=HEADERS,
-            timeout=TIMEOUT
-        ).raise_for_status()
+        resp = await http_client.put(url, json={"status": status})
+        resp.raise_for_status()
         print(f"✅ ERP Work Order {erp_work_order_id} → {status}")
     except Exception as e:
         print("❌ ERP status update failed:", e)
 
+async def _push_work_order_statuses(batch: Dict[str, str]):
+    """One frappe.client.bulk_update call; per-order PUTs in parallel if that fails."""
+    if not ERP_URL or not API_KEY or not API_SECRET:
+        return
+
+    docs = [
+        {"doctype": "Work Order", "docname": name, "status": status}
+        for name, status in batch.items()
+    ]
+    try:
+        resp = await http_client.post(
+            f"{ERP_URL}/api/method/frappe.client.bulk_update",
+            json={"docs": json.dumps(docs)}
+        )
+        resp.raise_for_status()
+        failed = (resp.json().get("message") or {}).get("failed_docs") or []
+        print(f"✅ ERP bulk status update: {len(docs) - len(failed)}/{len(docs)} Work Orders")
+        for doc in failed:
+            print("❌ ERP status update failed:", doc)
+    except Exception as e:
+        print("⚠ ERP bulk update failed, falling back to per-order updates:", e)
+        await asyncio.gather(*(
+            _put_work_order_status(name, status) for name, status in batch.items()
+        ))
+
+async def flush_pending():
+    """Send every queued status change now; also called on shutdown."""
+    if not _pending_statuses:
+        return
+    batch = dict(_pending_statuses)
+    _pending_statuses.clear()
+    try:
+        await _push_work_order_statuses(batch)
+    except asyncio.CancelledError:
+        # Put the batch back (newer statuses win) so shutdown can still send it
+        for name, status in batch.items():
+            _pending_statuses.setdefault(name, status)
+        raise
+    except Exception as e:
+        print("❌ ERP status flush error:", e)
+
+async def erp_status_flusher(interval: float = ERP_STATUS_FLUSH_INTERVAL):
+    """
+    Background loop: collect queued status changes for `interval` seconds,
+    then push the whole wave (latest status per Work Order) in one request.
+    """
+    while True:
+        await _status_wake.wait()
+        await asyncio.sleep(interval)
+        _status_wake.clear()
+        await flush_pending()
+
 # =====================================================
 # AUTO ASSIGN ERP WORK ORDERS TO MACHINES (SAFE)
 # =====================================================
-def auto_assign_work_orders():
+_last_sync_sig = None  # digest of the last run that had nothing to assign
+
+def _sync_signature(work_orders: List[Dict], machine_state: list) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps(work_orders, sort_keys=True).encode())
+    h.update(repr(machine_state).encode())
+    return h.digest()
+
+async def auto_assign_work_orders():
     """
     Assign ERPNext Work Orders to free machines based on:
     - Location
     - Pipe size preference
     - Machine availability
+    Skipped when neither the ERP list nor machine state changed since the last idle run.
     """
+    global _last_sync_sig
     db = SessionLocal()
     try:
-        work_orders = get_work_orders()
+        work_orders = await get_work_orders()
         if not work_orders:
             return
 
+        machine_state = [tuple(row) for row in db.query(
+            Machine.id, Machine.status, Machine.is_locked,
+            Machine.work_order, Machine.erpnext_work_order_id
+        ).order_by(Machine.id)]
+        sig = _sync_signature(work_orders, machine_state)
+        if sig == _last_sync_sig:
+            return
+
+        now = datetime.now(timezone.utc)  # one timestamp for every assignment in this run
+        wo_names = [wo["name"] for wo in work_orders]
+
+        # Prefetch assignments, metadata and free machines in three queries
+        assigned = {
+            row.erpnext_work_order_id
+            for row in db.query(Machine.erpnext_work_order_id).filter(
+                Machine.erpnext_work_order_id.in_(wo_names)
+            )
+        }
+        metas = {
+            meta.work_order: meta
+            for meta in db.query(ERPNextMetadata).filter(
+                ERPNextMetadata.work_order.in_(wo_names)
+            )
+        }
+        free_by_location = defaultdict(list)
+        for m in db.query(Machine).filter(
+            Machine.is_locked == False,
+            Machine.status.in_(["free", "paused", "stopped"])
+        ):
+            free_by_location[m.location].append(m)
+
+        changed = False
         for wo in work_orders:
             wo_name = wo["name"]
             wo_status = wo["status"]
@@ -116,31 +252,23 @@ def auto_assign_work_orders():
             produced = wo.get("produced_qty", 0)
 
             # Already assigned locally
-            existing = db.query(Machine).filter(
-                Machine.erpnext_work_order_id == wo_name
-            ).first()
-            if existing:
+            if wo_name in assigned:
                 continue
 
             # Find free machines
-            free_machines = db.query(Machine).filter(
-                Machine.location == location,
-                Machine.is_locked == False,
-                Machine.status.in_(["free", "paused", "stopped"])
-            ).all()
-
+            free_machines = free_by_location.get(location)
             if not free_machines:
                 continue
 
             # Prefer pipe size match
-            selected_machine = None
-            for m in free_machines:
-                if m.pipe_size == pipe_size:
-                    selected_machine = m
-                    break
+            selected_machine = next(
+                (m for m in free_machines if m.pipe_size == pipe_size),
+                free_machines[0]
+            )
 
-            if not selected_machine:
-                selected_machine = free_machines[0]
+            # Taken: the next WO in this location must pick another machine
+            free_machines.remove(selected_machine)
+            assigned.add(wo_name)
 
             # Assign work order
             selected_machine.erpnext_work_order_id = wo_name
@@ -152,50 +280,63 @@ def auto_assign_work_orders():
             selected_machine.is_locked = True
 
             # Metadata update
-            meta = db.query(ERPNextMetadata).filter(
-                ERPNextMetadata.work_order == wo_name
-            ).first()
+            meta = metas.get(wo_name)
 
             if not meta:
                 meta = ERPNextMetadata(
                     machine_id=selected_machine.id,
                     work_order=wo_name,
                     erp_status="Assigned",
-                    last_synced=datetime.now()
+                    last_synced=now
                 )
                 db.add(meta)
+                metas[wo_name] = meta
             else:
                 meta.machine_id = selected_machine.id
                 meta.erp_status = "Assigned"
-                meta.last_synced = datetime.now()
+                meta.last_synced = now
 
-            db.commit()
+            changed = True
             print(f"🟢 Assigned ERP WO {wo_name} → Machine {selected_machine.name}")
 
-    except SQLAlchemyError as e:
+        if changed:
+            db.commit()
+        else:
+            _last_sync_sig = sig
+
+    except SQLAlchemyError:
         db.rollback()
-        print("❌ DB error:", e)
-    except Exception as e:
+        logger.exception("❌ DB error during auto-assign")
+    except Exception:
         db.rollback()
-        print("❌ Auto-assign error:", e)
+        logger.exception("❌ Auto-assign error")
     finally:
         db.close()
 
 # =====================================================
 # ERPNext SYNC LOOP (PRODUCTION)
 # =====================================================
-async def erpnext_sync_loop(interval: int = 10):
+# Set when a machine completes/stops so free capacity is assigned right away
+erp_wake = asyncio.Event()
+
+async def erpnext_sync_loop(interval: int = ERP_SYNC_MAX_INTERVAL):
     """
-    Continuous ERPNext sync loop
-    - Fetch work orders
+    Event-driven ERPNext sync loop
+    - Fetch work orders (refreshes the shared cache)
     - Auto-assign to machines
+    - Sleep until erp_wake is set, at most `interval` seconds
     """
     print("🚀 ERPNext Production Sync Loop Started")
 
     while True:
         try:
-            auto_assign_work_orders()
-        except Exception as e:
-            print("❌ ERP Sync Loop error:", e)
+            await get_work_orders(0)
+            await auto_assign_work_orders()
+        except Exception:
+            logger.exception("❌ ERP Sync Loop error")
 
-        await asyncio.sleep(interval)
+        try:
+            await asyncio.wait_for(erp_wake.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        erp_wake.clear()
@@ -5,17 +5,24 @@
 
 from fastapi import FastAPI, Depends, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import insert, select, update
 from sqlalchemy.orm import Session
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import asyncio
+from collections import defaultdict, deque
+import time
 from pydantic import BaseModel
 
-from database import engine, SessionLocal, init_db
+from database import engine, SessionLocal, init_db, IS_POSTGRES, MACHINE_EVENTS_CHANNEL
 from models import Machine, ProductionLog, ScheduledJob, ERPNextMetadata
 from erpnext_sync import (
+    erp_status_flusher,
+    erp_wake,
+    erpnext_sync_loop,
+    flush_pending,
+    http_client,
     update_work_order_status,
-    get_work_orders,
-    auto_assign_work_orders
+    get_work_orders
 )
 from report import router as report_router  # Production Report Router
 
@@ -51,24 +58,72 @@ def get_db():
 # =====================================================
 # WEBSOCKET MANAGER
 # =====================================================
+class Outbox:
+    """Pending frames for one client: latest dashboard snapshot + every alert, in order."""
+
+    def __init__(self):
+        self.snapshot = None
+        self.alerts = deque()
+        self.ready = asyncio.Event()
+
+
 class ConnectionManager:
+    ALERT_BACKLOG_LIMIT = 256  # unsent alerts before a client is considered dead
+
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        # ws -> its outbox; dict keys give O(1) connect/disconnect
+        self.active_connections: dict[WebSocket, Outbox] = {}
+        self._writers: dict[WebSocket, asyncio.Task] = {}
+        self._closing: set[asyncio.Task] = set()  # strong refs until the close frame is out
 
     async def connect(self, ws: WebSocket):
         await ws.accept()
-        self.active_connections.append(ws)
+        outbox = Outbox()
+        self.active_connections[ws] = outbox
+        self._writers[ws] = asyncio.create_task(self._writer(ws, outbox))
 
     def disconnect(self, ws: WebSocket):
-        if ws in self.active_connections:
-            self.active_connections.remove(ws)
+        self.active_connections.pop(ws, None)
+        task = self._writers.pop(ws, None)
+        if task and task is not asyncio.current_task():
+            task.cancel()
+
+    async def _writer(self, ws: WebSocket, outbox: Outbox):
+        try:
+            while True:
+                await outbox.ready.wait()
+                outbox.ready.clear()
+                while outbox.alerts:
+                    await ws.send_json(outbox.alerts.popleft())
+                if outbox.snapshot is not None:
+                    data, outbox.snapshot = outbox.snapshot, None
+                    await ws.send_json(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(ws)
+
+    async def _close(self, ws: WebSocket):
+        try:
+            await ws.close(code=1013)  # try again later
+        except Exception:
+            pass
 
     async def broadcast(self, data: dict):
-        for ws in list(self.active_connections):
-            try:
-                await ws.send_json(data)
-            except Exception:
+        # Never awaits a socket: one slow client cannot hold up the others
+        for ws, outbox in list(self.active_connections.items()):
+            if "locations" in data:
+                outbox.snapshot = data  # stale dashboard state is simply replaced
+            elif len(outbox.alerts) < self.ALERT_BACKLOG_LIMIT:
+                outbox.alerts.append(data)
+            else:
+                # Hopelessly behind: drop the client rather than silently losing alerts
                 self.disconnect(ws)
+                task = asyncio.create_task(self._close(ws))
+                self._closing.add(task)
+                task.add_done_callback(self._closing.discard)
+                continue
+            outbox.ready.set()
 
 manager = ConnectionManager()
 
@@ -76,31 +131,46 @@ manager = ConnectionManager()
 # DASHBOARD DATA WITH ETA & METADATA
 # =====================================================
 def get_dashboard_data(db: Session):
-    response = []
-    machines = db.query(Machine).all()
-    metadata_map = {m.work_order: m for m in db.query(ERPNextMetadata).all()}
-    locations = {}
+    # Only the columns the dashboard renders, metadata LEFT JOINed in the same query
+    machines = db.execute(select(
+        Machine.id, Machine.name, Machine.location, Machine.status,
+        Machine.work_order, Machine.pipe_size, Machine.target_qty,
+        Machine.produced_qty, Machine.seconds_per_meter,
+        ERPNextMetadata.erp_status, ERPNextMetadata.erp_comments
+    ).outerjoin(Machine.erp_meta)).all()
+    locations = defaultdict(list)
     next_jobs = {}
 
     for m in machines:
+        machines_list = locations[m.location]
+
+        # Idle machine: nothing to compute
+        if not m.work_order:
+            machines_list.append({
+                "id": m.id,
+                "name": m.name,
+                "status": m.status,
+                "job": None,
+                "next_job": next_jobs.get(m.location)
+            })
+            continue
+
         remaining_qty = (m.target_qty - m.produced_qty) if m.target_qty else 0
         remaining_time = remaining_qty * m.seconds_per_meter if m.seconds_per_meter else None
         progress_percent = (m.produced_qty / m.target_qty) * 100 if m.target_qty else 0
-        erp_meta = metadata_map.get(m.work_order)
 
         # Determine next job per location
-        if m.status in ["free", "stopped"] and m.work_order:
-            if m.location not in next_jobs:
-                next_jobs[m.location] = {
-                    "machine_id": m.id,
-                    "work_order": m.work_order,
-                    "pipe_size": m.pipe_size,
-                    "total_qty": m.target_qty,
-                    "produced_qty": m.produced_qty,
-                    "remaining_time": remaining_time
-                }
-
-        locations.setdefault(m.location, []).append({
+        if m.status in ("free", "stopped") and m.location not in next_jobs:
+            next_jobs[m.location] = {
+                "machine_id": m.id,
+                "work_order": m.work_order,
+                "pipe_size": m.pipe_size,
+                "total_qty": m.target_qty,
+                "produced_qty": m.produced_qty,
+                "remaining_time": remaining_time
+            }
+
+        machines_list.append({
             "id": m.id,
             "name": m.name,
             "status": m.status,
@@ -112,16 +182,40 @@ def get_dashboard_data(db: Session):
                 "remaining_qty": remaining_qty,
                 "remaining_time": remaining_time,
                 "progress_percent": progress_percent,
-                "erp_status": erp_meta.erp_status if erp_meta else None,
-                "erp_comments": erp_meta.erp_comments if erp_meta else None
-            } if m.work_order else None,
+                "erp_status": m.erp_status,
+                "erp_comments": m.erp_comments
+            },
             "next_job": next_jobs.get(m.location)
         })
 
-    for loc, machines_list in locations.items():
-        response.append({"name": loc, "machines": machines_list})
+    return [{"name": loc, "machines": machines_list} for loc, machines_list in locations.items()]
+
+# =====================================================
+# DASHBOARD BROADCASTER
+# =====================================================
+BROADCAST_MIN_INTERVAL = 0.5  # seconds between dashboard pushes
+_broadcast_pending = asyncio.Event()
+
+def request_broadcast():
+    """Mark the dashboard dirty; changes are coalesced into one push."""
+    _broadcast_pending.set()
 
-    return response
+async def dashboard_broadcaster():
+    while True:
+        await _broadcast_pending.wait()
+        _broadcast_pending.clear()
+        if manager.active_connections:
+            db = SessionLocal()
+            try:
+                payload = get_dashboard_data(db)
+            except Exception as e:
+                payload = None
+                print("BROADCAST ERROR:", e)
+            finally:
+                db.close()
+            if payload is not None:
+                await manager.broadcast({"locations": payload})
+        await asyncio.sleep(BROADCAST_MIN_INTERVAL)
 
 # =====================================================
 # HTTP API
@@ -131,8 +225,8 @@ def dashboard(db: Session = Depends(get_db)):
     return {"locations": get_dashboard_data(db)}
 
 @app.get("/api/job_queue")
-def job_queue(db: Session = Depends(get_db)):
-    work_orders = get_work_orders()
+async def job_queue(db: Session = Depends(get_db)):
+    work_orders = await get_work_orders()
     queue = []
     for wo in work_orders:
         if wo.get("status") == "Completed":
@@ -149,14 +243,15 @@ def job_queue(db: Session = Depends(get_db)):
 
 @app.get("/api/production_logs")
 def production_logs(db: Session = Depends(get_db), limit: int = 50):
-    logs = db.query(ProductionLog).order_by(ProductionLog.timestamp.desc()).limit(limit).all()
-    return {"logs": [{
-        "machine_id": l.machine_id,
-        "work_order": l.work_order,
-        "pipe_size": l.pipe_size,
-        "produced_qty": l.produced_qty,
-        "timestamp": l.timestamp.isoformat()
-    } for l in logs]}
+    # Plain row mappings: FastAPI serializes them (and the datetimes) directly
+    logs = db.execute(select(
+        ProductionLog.machine_id,
+        ProductionLog.work_order,
+        ProductionLog.pipe_size,
+        ProductionLog.produced_qty,
+        ProductionLog.timestamp
+    ).order_by(ProductionLog.timestamp.desc()).limit(limit)).mappings().all()
+    return {"logs": logs}
 
 # =====================================================
 # Pydantic Models for JSON POST
@@ -177,7 +272,8 @@ def get_machine(db: Session, location: str, machine_id: int):
 # =====================================================
 # MACHINE CONTROLS + ERP STATUS UPDATE
 # =====================================================
-async def update_machine_status(db: Session, m: Machine, new_status: str):
+async def update_machine_status(db: Session, m: Machine, new_status: str, commit: bool = True):
+    # commit=False lets a caller fold this into its own transaction and commit once
     m.status = new_status
     if new_status == "running":
         m.is_locked = True
@@ -187,8 +283,14 @@ async def update_machine_status(db: Session, m: Machine, new_status: str):
         m.is_locked = False
         update_work_order_status(m.erpnext_work_order_id, "Completed")
 
-    db.commit()
-    await manager.broadcast({"locations": get_dashboard_data(db)})
+    if commit:
+        db.commit()
+    if new_status in ("completed", "stopped"):
+        erp_wake.set()
+    if new_status == "running":
+        # Only a start can bring the next meter forward (the meter loop itself only completes)
+        _meter_wake.set()
+    request_broadcast()
 
 @app.post("/api/machine/start")
 async def start_machine(data: MachineAction, db: Session = Depends(get_db)):
@@ -205,7 +307,7 @@ async def pause_machine(data: MachineAction, db: Session = Depends(get_db)):
         return {"ok": False}
     m.status = "paused"
     db.commit()
-    await manager.broadcast({"locations": get_dashboard_data(db)})
+    request_broadcast()
     return {"ok": True}
 
 @app.post("/api/machine/stop")
@@ -223,95 +325,212 @@ async def rename_machine(data: MachineRename, db: Session = Depends(get_db)):
         return {"ok": False}
     m.name = data.new_name
     db.commit()
-    await manager.broadcast({"locations": get_dashboard_data(db)})
+    request_broadcast()
     return {"ok": True}
 
 # =====================================================
 # AUTOMATIC METER COUNTER + ERP STATUS
 # =====================================================
+METER_IDLE_TIMEOUT = 60  # seconds, safety sweep when no machine is running
+_meter_wake = asyncio.Event()
+
+def _as_utc(dt: datetime) -> datetime:
+    # SQLite hands back naive datetimes; treat them as UTC
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
 async def automatic_meter_counter():
     while True:
         db = SessionLocal()
+        next_sleep = METER_IDLE_TIMEOUT
         try:
-            machines = db.query(Machine).filter(Machine.status == "running").all()
+            # Plain rows, no ORM objects: only completed machines get loaded below
+            machines = db.execute(select(
+                Machine.id, Machine.location, Machine.work_order, Machine.pipe_size,
+                Machine.target_qty, Machine.produced_qty, Machine.seconds_per_meter,
+                Machine.last_tick_time
+            ).where(
+                Machine.status == "running",
+                Machine.seconds_per_meter > 0,
+                Machine.work_order.isnot(None),
+                Machine.work_order != ""
+            )).all()
             now = datetime.now(timezone.utc)
-            updated = False
+            updates = []
+            new_logs = []
+            ticked_orders = set()
+            completed_ids = []
+            waits = []
 
             for m in machines:
-                if not m.seconds_per_meter or not m.work_order:
-                    continue
                 if not m.last_tick_time:
-                    m.last_tick_time = now
+                    updates.append({"id": m.id, "last_tick_time": now})
+                    waits.append(m.seconds_per_meter)
                     continue
 
-                diff = (now - m.last_tick_time).total_seconds()
-                if diff >= m.seconds_per_meter and m.produced_qty < m.target_qty:
-                    m.produced_qty += 1
-                    m.last_tick_time = now
-                    updated = True
-
-                    db.add(ProductionLog(
-                        machine_id=m.id,
-                        work_order=m.work_order,
-                        pipe_size=m.pipe_size,
-                        produced_qty=1,
-                        timestamp=now
-                    ))
-
-                    meta = db.query(ERPNextMetadata).filter(ERPNextMetadata.work_order == m.work_order).first()
-                    if meta:
-                        meta.erp_status = "In Progress"
-                        meta.last_synced = now
-
-                    if m.produced_qty >= m.target_qty:
-                        m.produced_qty = m.target_qty
-                        await update_machine_status(db, m, "completed")
-                        if meta:
-                            meta.erp_status = "Completed"
-
+                # Catch up every whole meter produced since the last tick in one pass
+                last_tick = _as_utc(m.last_tick_time)
+                diff = (now - last_tick).total_seconds()
+                ticks = min(int(diff // m.seconds_per_meter), m.target_qty - m.produced_qty)
+
+                if ticks > 0:
+                    new_logs.extend({
+                        "machine_id": m.id,
+                        "location": m.location,
+                        "work_order": m.work_order,
+                        "pipe_size": m.pipe_size,
+                        "produced_qty": 1,
+                        "status": "running",
+                        "timestamp": last_tick + timedelta(seconds=i * m.seconds_per_meter)
+                    } for i in range(1, ticks + 1))
+                    updates.append({
+                        "id": m.id,
+                        "produced_qty": m.produced_qty + ticks,
+                        "last_tick_time": last_tick + timedelta(seconds=ticks * m.seconds_per_meter)
+                    })
+                    ticked_orders.add(m.work_order)
+
+                    if m.produced_qty + ticks >= m.target_qty:
+                        completed_ids.append(m.id)
+                        continue
+
+                # Time left until this machine finishes its next meter
+                waits.append(m.seconds_per_meter - (diff % m.seconds_per_meter))
+
+            updated = bool(updates)
+            if updates:
+                db.bulk_update_mappings(Machine, updates)
+            if ticked_orders:
+                db.execute(
+                    update(ERPNextMetadata)
+                    .where(ERPNextMetadata.work_order.in_(ticked_orders))
+                    .values(erp_status="In Progress", last_synced=now)
+                    .execution_options(synchronize_session=False)
+                )
+
+            # Only machines that hit their target go through the full status change
+            if completed_ids:
+                completed = db.query(Machine).filter(Machine.id.in_(completed_ids)).all()
+                for m in completed:
+                    await update_machine_status(db, m, "completed", commit=False)
+                db.execute(
+                    update(ERPNextMetadata)
+                    .where(ERPNextMetadata.work_order.in_({m.work_order for m in completed}))
+                    .values(erp_status="Completed")
+                    .execution_options(synchronize_session=False)
+                )
+
+            # One executemany INSERT for every meter logged this pass
+            if new_logs:
+                db.execute(insert(ProductionLog), new_logs)
             if updated:
                 db.commit()
-                await manager.broadcast({"locations": get_dashboard_data(db)})
+                request_broadcast()
+
+            if waits:
+                next_sleep = max(0.1, min(waits))
 
         except Exception as e:
             print("AUTO METER ERROR:", e)
         finally:
             db.close()
-        await asyncio.sleep(1)
+
+        # Sleep until the soonest machine is due, or until a machine start wakes us
+        try:
+            await asyncio.wait_for(_meter_wake.wait(), timeout=next_sleep)
+        except asyncio.TimeoutError:
+            pass
+        _meter_wake.clear()
+
+async def machine_event_listener():
+    """
+    PostgreSQL LISTEN on machine starts (trigger from init_db).
+    Wakes the meter loop for starts made by any process, not just this one.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        raw = None
+        fd = None
+        try:
+            # Dedicated pooled connection; invalidated on exit since it is left in autocommit
+            raw = engine.raw_connection()
+            conn = raw.driver_connection
+            # The checkout (e.g. pre_ping) may have opened a transaction; autocommit can't be set inside one
+            conn.rollback()
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {MACHINE_EVENTS_CHANNEL}")
+
+            # Notifications are read by the event loop itself: no thread to outlive a cancel
+            lost = loop.create_future()
+
+            def on_readable():
+                try:
+                    conn.poll()
+                except Exception as e:
+                    if not lost.done():
+                        lost.set_exception(e)
+                    return
+                if conn.notifies:
+                    conn.notifies.clear()
+                    _meter_wake.set()
+
+            fd = conn.fileno()
+            loop.add_reader(fd, on_readable)
+            await lost
+        except Exception as e:
+            print("MACHINE EVENT LISTENER ERROR:", e)
+        finally:
+            if fd is not None:
+                loop.remove_reader(fd)
+            if raw is not None:
+                raw.invalidate()
+        await asyncio.sleep(METER_IDLE_TIMEOUT)
 
 # =====================================================
 # PRODUCTION ALERTS
 # =====================================================
-alert_history = {}
+ALERT_THRESHOLDS = ((3, 100), (2, 90), (1, 75))  # (level, percent), highest first
+ALERT_COOLDOWN = 30  # seconds before a machine may re-alert after a reset/drop
+alert_history = {}  # machine_id -> (level, monotonic time of last broadcast)
 
 async def production_alerts():
     while True:
         db = SessionLocal()
         try:
-            machines = db.query(Machine).filter(Machine.target_qty > 0).all()
+            machines = db.query(
+                Machine.id, Machine.name, Machine.produced_qty, Machine.target_qty
+            ).filter(
+                Machine.target_qty > 0,
+                Machine.status == "running",
+                Machine.work_order.isnot(None),
+                Machine.work_order != ""
+            ).all()
             for m in machines:
-                if not m.work_order or m.status != "running":
-                    continue
                 percent = (m.produced_qty / m.target_qty) * 100
-                last_level = alert_history.get(m.id, 0)
-                alert_level = 0
-                message = None
+                last_level, last_ts = alert_history.get(m.id, (0, float("-inf")))
+
+                if percent < ALERT_THRESHOLDS[-1][1]:
+                    if last_level:
+                        alert_history[m.id] = (0, last_ts)
+                    continue
 
-                if percent >= 100:
-                    alert_level = 3
+                alert_level = next(level for level, pct in ALERT_THRESHOLDS if percent >= pct)
+                if alert_level == last_level:
+                    continue
+
+                # Escalations always go out; anything else is rate-limited
+                now = time.monotonic()
+                if not (last_level and alert_level > last_level) and now - last_ts < ALERT_COOLDOWN:
+                    continue
+
+                if alert_level == 3:
                     message = f"✅ Machine {m.name} COMPLETED"
-                elif percent >= 90:
-                    alert_level = 2
+                elif alert_level == 2:
                     message = f"⚠ {m.name} CRITICAL {percent:.1f}%"
-                elif percent >= 75:
-                    alert_level = 1
+                else:
                     message = f"⚠ {m.name} Warning {percent:.1f}%"
 
-                if alert_level > 0 and alert_level != last_level:
-                    alert_history[m.id] = alert_level
-                    await manager.broadcast({"alert": message, "machine_id": m.id, "level": alert_level})
-                elif percent < 75:
-                    alert_history[m.id] = 0
+                alert_history[m.id] = (alert_level, now)
+                await manager.broadcast({"alert": message, "machine_id": m.id, "level": alert_level})
 
         except Exception as e:
             print("ALERT LOOP ERROR:", e)
@@ -319,18 +538,6 @@ async def production_alerts():
             db.close()
         await asyncio.sleep(5)
 
-# =====================================================
-# ERPNext SYNC LOOP
-# =====================================================
-async def erpnext_sync_loop(interval: int = 10):
-    print("🚀 ERPNext Sync Loop started")
-    while True:
-        try:
-            auto_assign_work_orders()
-        except Exception as e:
-            print("❌ ERP Sync Loop error:", e)
-        await asyncio.sleep(interval)
-
 # =====================================================
 # WEBSOCKET
 # =====================================================
@@ -370,6 +577,21 @@ async def startup_event():
     db.close()
 
     # Startup tasks
+    asyncio.create_task(dashboard_broadcaster())
     asyncio.create_task(automatic_meter_counter())
+    if IS_POSTGRES and engine.dialect.driver == "psycopg2":
+        asyncio.create_task(machine_event_listener())
     asyncio.create_task(production_alerts())
     asyncio.create_task(erpnext_sync_loop())
+    app.state.erp_flusher = asyncio.create_task(erp_status_flusher())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Queued ERP status changes must go out before the client closes
+    app.state.erp_flusher.cancel()
+    try:
+        await app.state.erp_flusher
+    except asyncio.CancelledError:
+        pass
+    await flush_pending()
+    await http_client.aclose()
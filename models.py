@@ -3,7 +3,8 @@
 # Steps 1 → 43 FULLY UPDATED & ERPNext Ready
 # =====================================================
 
-from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, Index
+from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, ForeignKey, Index, and_, func, select
+from sqlalchemy.orm import relationship, foreign, aliased
 from database import Base
 from datetime import datetime, timezone
 
@@ -25,6 +26,7 @@ class Machine(Base):
     work_order = Column(String, nullable=True, default="")
     pipe_size = Column(String, nullable=True, default="")
     erpnext_work_order_id = Column(String, nullable=True, default="")
+    is_locked = Column(Boolean, nullable=False, default=False)
 
     # -------------------------------
     # HELPER METHODS
@@ -92,6 +94,26 @@ class ERPNextMetadata(Base):
     last_synced = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
 
+# Machine → ERPNext metadata of its current work order (joined on work_order).
+# work_order is not unique in erpnext_metadata, so only the newest row (highest id)
+# joins; otherwise a LEFT JOIN would repeat the machine once per metadata row.
+# Class references, not strings: database.py maps same-named classes on this Base.
+_newer_meta = aliased(ERPNextMetadata)
+
+Machine.erp_meta = relationship(
+    ERPNextMetadata,
+    primaryjoin=lambda: and_(
+        foreign(ERPNextMetadata.work_order) == Machine.work_order,
+        ERPNextMetadata.id == select(func.max(_newer_meta.id))
+        .where(_newer_meta.work_order == Machine.work_order)
+        .correlate_except(_newer_meta)
+        .scalar_subquery()
+    ),
+    viewonly=True,
+    uselist=False
+)
+
+
 # =====================================================
 # SCHEDULED JOB TABLE
 # =====================================================
@@ -115,5 +137,7 @@ class ScheduledJob(Base):
 # INDEXING FOR PERFORMANCE
 # =====================================================
 Index("idx_machine_work_order", Machine.work_order)
+Index("idx_machine_erpnext_work_order_id", Machine.erpnext_work_order_id)
+Index("idx_machine_location_locked_status", Machine.location, Machine.is_locked, Machine.status)
 Index("idx_erp_metadata_work_order", ERPNextMetadata.work_order)
 Index("idx_production_log_location", ProductionLog.location)
@@ -75,7 +75,7 @@ async def erpnext_sync_loop():
     while True:
         db = SessionLocal()
         try:
-            work_orders = get_work_orders()
+            work_orders = await get_work_orders()
             updated = False
 
             for wo in work_orders:
@@ -113,7 +113,7 @@ async def erpnext_sync_loop():
 async def auto_assign_loop():
     while True:
         try:
-            auto_assign_work_orders()
+            await auto_assign_work_orders()
         except Exception as e:
             print(f"Auto-assign loop error: {e}")
         await asyncio.sleep(AUTO_ASSIGN_INTERVAL)